@@ -1,140 +1,223 @@
-import chainlit as cl
-import subprocess
 import os
+# Cap native thread pools (OpenMP/MKL) before NumPy and ONNX Runtime are imported,
+# so they don't oversubscribe cores alongside the event loop and Ollama
+os.environ.setdefault("OMP_NUM_THREADS", "4")
+os.environ.setdefault("MKL_NUM_THREADS", "4")
+import chainlit as cl
+import asyncio
+import functools
+import heapq
+import itertools
+import re
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_ollama import ChatOllama, OllamaEmbeddings
-from langchain_community.vectorstores import LanceDB
-from langchain_community.retrievers import BM25Retriever
-from langchain_community.document_loaders import DirectoryLoader, TextLoader, PyPDFLoader, UnstructuredExcelLoader
-from langchain_core.documents import Document
+from langchain_ollama import ChatOllama
 from langgraph.graph import StateGraph, END
 from typing import TypedDict, List
-from flashrank import Ranker, RerankRequest
+from flashrank import RerankRequest
+from ingest import IngestionInProgress, run_ingestion
+from retrieval import (
+    OLLAMA_CLIENT_KWARGS,
+    OLLAMA_KEEP_ALIVE,
+    CachedOllamaEmbeddings,
+    QuantizedRanker,
+    VectorIndex,
+    load_or_build_bm25_index,
+    rrf_fuse,
+    rrf_top,
+)
 
 # --- Config ---
 MODEL = "llama3.2:3b"
 EMBEDDING = "nomic-embed-text"
 DOCS_DIR = "/Users/swarnabha.saha/Library/CloudStorage/OneDrive-RelianceCorporateITParkLimited/Personal/Personal RAG/Docs"
+# Optional: generate with llama.cpp's OpenAI-compatible server using speculative decoding
+# (1B draft model, Metal offload), e.g.
+#   llama-server -m Llama-3.2-3B-Instruct-Q4_K_M.gguf -md Llama-3.2-1B-Instruct-Q4_K_M.gguf --draft-max 8 -ngl 99 --port 8080
+# then set LLAMA_SERVER_URL=http://localhost:8080/v1. Unset, Ollama is used.
+LLAMA_SERVER_URL = os.environ.get("LLAMA_SERVER_URL")
 
 # --- Setup ---
 print("Initializing Embeddings...")
-embeddings = OllamaEmbeddings(model=EMBEDDING)
+embeddings = CachedOllamaEmbeddings(model=EMBEDDING, keep_alive=OLLAMA_KEEP_ALIVE, client_kwargs=OLLAMA_CLIENT_KWARGS)
 
 print("Initializing Vector Store...")
 # Ensure directory exists, otherwise LanceDB might fail if empty
 if not os.path.exists("./lancedb_data"):
     os.makedirs("./lancedb_data")
-vector_store = LanceDB(embedding=embeddings, uri="./lancedb_data")
+vector_store = VectorIndex("./lancedb_data", embeddings)
 
 # FlashRank for Reranking (runs locally on CPU/M1)
 print("Initializing Re-ranker...")
-reranker = Ranker(model_name="ms-marco-TinyBERT-L-2-v2", cache_dir="./.flashrank_cache")
-
-# Helper to load docs for BM25 (Keyword Search)
-def load_docs_for_bm25(directory):
-    print("Loading documents for BM25 index...")
-    loaders = {
-        ".pdf": PyPDFLoader,
-        ".txt": TextLoader,
-        ".md": TextLoader,
-    }
-    documents = []
-    if os.path.exists(directory):
-        for root, _, files in os.walk(directory):
-            for file in files:
-                ext = os.path.splitext(file)[1]
-                if ext in loaders:
-                    try:
-                        loader = loaders[ext](os.path.join(root, file))
-                        documents.extend(loader.load())
-                    except Exception as e:
-                        print(f"BM25 Load Error: {e}")
-    return documents
+reranker = QuantizedRanker(model_name="ms-marco-TinyBERT-L-2-v2", cache_dir="./.flashrank_cache")
 
 # Initialize BM25 Retriever
 print("Initializing BM25 Retriever...")
-docs = load_docs_for_bm25(DOCS_DIR)
-if docs:
-    bm25_retriever = BM25Retriever.from_documents(docs)
-    bm25_retriever.k = 10
-else:
-    print("Warning: No documents found for BM25. Keyword search will be disabled.")
-    bm25_retriever = None
+bm25_retriever = load_or_build_bm25_index()
+if not bm25_retriever:
+    print("Warning: No ingested chunks found for BM25. Keyword search will be disabled.")
 
 print("Initializing LLM...")
-llm = ChatOllama(model=MODEL, temperature=0, keep_alive="5m")
+if LLAMA_SERVER_URL:
+    from langchain_openai import ChatOpenAI
+    # temperature=0 keeps greedy decoding, which maximizes draft-token acceptance
+    llm = ChatOpenAI(base_url=LLAMA_SERVER_URL, api_key="sk-no-key-required", model=MODEL, temperature=0)
+else:
+    llm = ChatOllama(model=MODEL, temperature=0, keep_alive=OLLAMA_KEEP_ALIVE, client_kwargs=OLLAMA_CLIENT_KWARGS)
+
+# Load both models into Ollama now so the first question doesn't pay the cold-start.
+# Only an optimization: if Ollama isn't up yet, start anyway and load them on first use
+print("Warming up models...")
+try:
+    embeddings.warm_up()
+    llm.invoke("Reply with OK.")
+except Exception as e:
+    print(f"Warning: model warm-up failed, continuing without it: {e}")
 
 # --- LangGraph State ---
 class AgentState(TypedDict):
     question: str
     expanded_queries: List[str]
-    retrieved_docs: List[Document]
     context: List[str]
     answer: str
 
 # --- Nodes ---
 
-def query_expansion(state: AgentState):
-    print(f"Expanding Query: {state['question']}")
-    prompt = ChatPromptTemplate.from_template(
-        """You are an AI research assistant. Your task is to generate 3 different search queries based on the user's question to improve retrieval coverage.
+# Greetings/acknowledgements never need retrieval coverage. Anything under 4 words is
+# already skipped; this catches longer ones like "ok, thanks a lot for that!"
+ACKNOWLEDGEMENT = r"(hi|hello|hey|thanks|thank you|thx|ok|okay|cool|great|perfect|got it|sounds good|bye|goodbye)"
+ACKNOWLEDGEMENT_FILLER = r"(so much|a lot|very much|again|for (that|this|the help|your help|everything)|that helps)"
+TRIVIAL_PATTERN = re.compile(
+    rf"^{ACKNOWLEDGEMENT}([\s!.,]+({ACKNOWLEDGEMENT}|{ACKNOWLEDGEMENT_FILLER}))*[\s!.,]*$", re.IGNORECASE
+)
+# Quoted phrases and numeric IDs are lexical lookups; a HyDE passage only dilutes them
+LEXICAL_PATTERN = re.compile(r'"[^"]+"|\d{3,}')
+
+def is_trivial(question: str) -> bool:
+    return len(question.split()) < 4 or bool(TRIVIAL_PATTERN.match(question.strip()))
+
+def route_question(state: AgentState):
+    if is_trivial(state["question"]):
+        print(f"Skipping query expansion for: {state['question']}")
+        return "retrieve_and_rerank"
+    return "query_expansion"
+
+@functools.lru_cache(maxsize=256)
+def expand_query(question: str, with_hyde: bool):
+    # Cached on the normalized question, so repeated questions skip the LLM call
+    if with_hyde:
+        template = """You are an AI research assistant. Your task is to generate 3 different search queries based on the user's question to improve retrieval coverage.
         Also generate 1 hypothetical passage that might answer the question (HyDE).
         
         User Question: {question}
 
         Output ONLY the 3 queries and 1 hypothetical passage, one per line. No numbering, no bullets.
         """
-    )
-    chain = prompt | llm
-    response = chain.invoke({"question": state["question"]})
+    else:
+        template = """You are an AI research assistant. Your task is to generate 3 different search queries based on the user's question to improve retrieval coverage.
+        Keep any quoted phrases and identifiers exactly as written.
+        
+        User Question: {question}
+
+        Output ONLY the 3 queries, one per line. No numbering, no bullets.
+        """
+    chain = ChatPromptTemplate.from_template(template) | llm
+    response = chain.invoke({"question": question})
     queries = response.content.strip().split("\n")
     # Clean up potentially empty lines
-    queries = [q.strip() for q in queries if q.strip()]
-    return {"expanded_queries": queries}
+    return tuple(q.strip() for q in queries if q.strip())
 
-def hybrid_retrieve(state: AgentState):
-    print("Executing Hybrid Retrieval...")
-    unique_docs = {}
+def query_expansion(state: AgentState):
+    print(f"Expanding Query: {state['question']}")
+    question = " ".join(state["question"].split())
+    with_hyde = not LEXICAL_PATTERN.search(question)
+    return {"expanded_queries": list(expand_query(question, with_hyde))}
+
+# Reranking starts on partial retrieval results: a batch is scored once it holds
+# RERANK_BATCH_SIZE new candidates or no new results arrived for RERANK_BATCH_WINDOW seconds.
+RERANK_BATCH_SIZE = 8
+RERANK_BATCH_WINDOW = 0.05
+RERANK_TOP_K = 5
+
+async def retrieve_and_rerank(state: AgentState):
+    print("Executing Hybrid Retrieval + Reranking...")
+    question = state["question"]
     
     # 1. Vector Search (Original + Expanded)
-    search_queries = [state["question"]] + state.get("expanded_queries", [])
-    
-    # Deduplicate queries to save compute
-    search_queries = list(set(search_queries))
+    search_queries = [question] + state.get("expanded_queries", [])
     
+    # Deduplicate queries (case/whitespace-insensitive) to save compute
+    seen = set()
+    deduped_queries = []
     for q in search_queries:
-        print(f"Vector search for: {q}")
-        v_results = vector_store.similarity_search(q, k=5)
-        for doc in v_results:
-            unique_docs[doc.page_content] = doc # Key by content to dedupe
+        key = " ".join(q.lower().split())
+        if key not in seen:
+            seen.add(key)
+            deduped_queries.append(q)
+    search_queries = deduped_queries
+    
+    # Every search is independent: run them concurrently in worker threads and
+    # push each result list onto the queue as soon as it arrives
+    results_queue = asyncio.Queue()
+
+    async def search(kind, fn, query, **kwargs):
+        try:
+            passages = await asyncio.to_thread(fn, query, **kwargs)
+        except Exception as e:
+            print(f"{kind} search error: {e}")
+            passages = []
+        await results_queue.put(passages)
+
+    tasks = []
 
-    # 2. Keyword Search (BM25) - Only on original query
+    # 2. Keyword Search (BM25) - Only on original query; started first so it
+    # overlaps with the query embedding below
     if bm25_retriever:
-        print(f"Keyword search for: {state['question']}")
-        k_results = bm25_retriever.invoke(state["question"])
-        for doc in k_results:
-             unique_docs[doc.page_content] = doc
-             
-    combined_docs = list(unique_docs.values())
-    print(f"Total unique docs retrieved: {len(combined_docs)}")
-    return {"retrieved_docs": combined_docs}
-
-def rerank(state: AgentState):
-    print("Reranking documents...")
-    docs = state["retrieved_docs"]
-    if not docs:
-        return {"context": []}
-    
-    passages = [
-        {"id": str(i), "text": doc.page_content, "meta": doc.metadata} 
-        for i, doc in enumerate(docs)
-    ]
-    
-    rerank_request = RerankRequest(query=state["question"], passages=passages)
-    results = reranker.rerank(rerank_request)
-    
-    # Sort and take (Top 5)
-    results = sorted(results, key=lambda x: x["score"], reverse=True)[:5]
+        print(f"Keyword search for: {question}")
+        tasks.append(asyncio.create_task(search("Keyword", bm25_retriever.search, question)))
+
+    # Embed all queries in one batched request instead of one Ollama round-trip per search
+    try:
+        query_vectors = await asyncio.to_thread(embeddings.embed_documents, search_queries)
+    except Exception as e:
+        # Fall back to the BM25 results alone rather than abandoning the running search
+        print(f"Query embedding error: {e}")
+        query_vectors = []
+    for q, query_vector in zip(search_queries, query_vectors):
+        print(f"Vector search for: {q}")
+        tasks.append(asyncio.create_task(search("Vector", vector_store.search_by_vector, query_vector, k=5)))
+
+    # 3. Rerank batches while the remaining searches are still running.
+    # Only passages currently in the RRF top RERANK_CANDIDATES reach the cross-encoder;
+    # a passage left out may still get in as later lists boost its fused score.
+    # Cross-encoder scores are per (query, passage) pair, so batch scores are
+    # directly comparable and the global top-k is a subset of the batch top-ks.
+    fused = {}  # chunk_key -> [rrf_score, passage]
+    scored = set()
+    top_results = []  # min-heap of (score, tiebreak, result)
+    tiebreak = itertools.count()
+    pending = len(tasks)
+    while pending:
+        try:
+            arrived = await asyncio.wait_for(results_queue.get(), timeout=RERANK_BATCH_WINDOW)
+            pending -= 1
+            rrf_fuse(fused, arrived)
+        except asyncio.TimeoutError:
+            arrived = None
+        batch = [key for key in rrf_top(fused) if key not in scored]
+        if batch and (arrived is None or not pending or len(batch) >= RERANK_BATCH_SIZE):
+            print(f"Reranking batch of {len(batch)} documents...")
+            scored.update(batch)
+            passages = [{"id": str(i), **fused[key][1]} for i, key in enumerate(batch)]
+            rerank_request = RerankRequest(query=question, passages=passages)
+            for res in await asyncio.to_thread(reranker.rerank, rerank_request, top_k=RERANK_TOP_K):
+                entry = (res["score"], next(tiebreak), res)
+                if len(top_results) < RERANK_TOP_K:
+                    heapq.heappush(top_results, entry)
+                else:
+                    heapq.heappushpop(top_results, entry)
+
+    print(f"Total unique docs retrieved: {len(fused)}, reranked: {len(scored)}")
+    results = [entry[2] for entry in heapq.nlargest(RERANK_TOP_K, top_results)]
     
     # Reconstruct context
     top_docs = [res["text"] for res in results]
@@ -144,7 +227,7 @@ def rerank(state: AgentState):
     
     return {"context": top_docs}
 
-def generate(state: AgentState):
+async def generate(state: AgentState):
     print("Generating answer with Chain-of-Thought...")
     prompt = ChatPromptTemplate.from_template(
         """You are an intelligent expert assistant. Answer the user's question using the provided context.
@@ -163,53 +246,64 @@ def generate(state: AgentState):
         """
     )
     chain = prompt | llm
-    response = chain.invoke({"context": "\n\n".join(state["context"]), "question": state["question"]})
+    # Async so the token stream reaches astream_events in the Chainlit handler
+    response = await chain.ainvoke({"context": "\n\n".join(state["context"]), "question": state["question"]})
     return {"answer": response.content}
 
 # --- Graph Construction ---
 workflow = StateGraph(AgentState)
 workflow.add_node("query_expansion", query_expansion)
-workflow.add_node("hybrid_retrieve", hybrid_retrieve)
-workflow.add_node("rerank", rerank)
+workflow.add_node("retrieve_and_rerank", retrieve_and_rerank)
 workflow.add_node("generate", generate)
 
-workflow.set_entry_point("query_expansion")
-workflow.add_edge("query_expansion", "hybrid_retrieve")
-workflow.add_edge("hybrid_retrieve", "rerank")
-workflow.add_edge("rerank", "generate")
+workflow.set_conditional_entry_point(
+    route_question,
+    {"query_expansion": "query_expansion", "retrieve_and_rerank": "retrieve_and_rerank"},
+)
+workflow.add_edge("query_expansion", "retrieve_and_rerank")
+workflow.add_edge("retrieve_and_rerank", "generate")
 workflow.add_edge("generate", END)
 
 app = workflow.compile()
 
 # --- UI Interface (Chainlit) ---
+# One ingestion at a time: a second refresh click is turned away instead of racing the first
+ingest_lock = asyncio.Lock()
+
 @cl.action_callback("refresh_data")
 async def on_action(action):
+    if ingest_lock.locked():
+        await cl.Message(content="⏳ Ingestion is already running.", author="System").send()
+        return
+
+    async with ingest_lock:
+        await refresh_knowledge_base()
+
+async def refresh_knowledge_base():
     msg = cl.Message(content="🔄 Running ingestion with Semantic Filtering...", author="System")
     await msg.send()
     
+    global bm25_retriever, vector_store
     try:
-        # Run ingest.py
-        result = subprocess.run(["python3", "ingest.py"], capture_output=True, text=True)
-        if result.returncode == 0:
-            # Reload BM25 and Vector Store
-            global bm25_retriever, vector_store
-            
-            # Re-init vector store
-            vector_store = LanceDB(embedding=embeddings, uri="./lancedb_data")
-            
-            # Re-init BM25
-            new_docs = load_docs_for_bm25(DOCS_DIR)
-            if new_docs:
-                bm25_retriever = BM25Retriever.from_documents(new_docs)
-                bm25_retriever.k = 10
-            
-            msg.content = "✅ Knowledge base updated! Semantic chunks created."
-            await msg.update()
-        else:
-            msg.content = f"❌ Ingestion failed:\n{result.stderr}"
-            await msg.update()
+        # Run ingestion in-process (off the event loop), reusing the warm embeddings
+        splits = await asyncio.to_thread(run_ingestion, DOCS_DIR, embeddings)
+
+        # Reload BM25 and Vector Store
+        # Re-init vector store
+        vector_store = VectorIndex("./lancedb_data", embeddings)
+        
+        # Re-init BM25
+        new_retriever = load_or_build_bm25_index()
+        if new_retriever:
+            bm25_retriever = new_retriever
+        
+        msg.content = f"✅ Knowledge base updated! {len(splits)} semantic chunks created."
+        await msg.update()
+    except IngestionInProgress as e:
+        msg.content = f"⏳ {e}"
+        await msg.update()
     except Exception as e:
-        msg.content = f"❌ Error: {str(e)}"
+        msg.content = f"❌ Ingestion failed:\n{str(e)}"
         await msg.update()
 
 @cl.on_chat_start
@@ -222,5 +316,10 @@ async def start():
 @cl.on_message
 async def main(message: cl.Message):
     inputs = {"question": message.content}
-    result = await app.ainvoke(inputs)
-    await cl.Message(content=result["answer"]).send()
+    msg = cl.Message(content="")
+    # Stream the answer token-by-token as the generate node produces it.
+    # Query expansion also calls the LLM, so filter its tokens out by node.
+    async for event in app.astream_events(inputs, version="v2"):
+        if event["event"] == "on_chat_model_stream" and event["metadata"].get("langgraph_node") == "generate":
+            await msg.stream_token(event["data"]["chunk"].content)
+    await msg.send()
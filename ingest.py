@@ -1,64 +1,168 @@
 import os
 import sys
+import fcntl
 import shutil
-from langchain_community.document_loaders import DirectoryLoader, TextLoader, PyPDFLoader, UnstructuredExcelLoader
+import itertools
+import multiprocessing
+import lancedb
+from concurrent.futures import ProcessPoolExecutor
+from langchain_community.document_loaders import TextLoader, PyPDFium2Loader, UnstructuredExcelLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_ollama import OllamaEmbeddings
+from langchain_core.embeddings import Embeddings
 from langchain_community.vectorstores import LanceDB
+from model2vec import StaticModel
+from retrieval import (
+    CHUNKS_PATH,
+    VECTOR_TABLE,
+    CachedOllamaEmbeddings,
+    load_or_build_bm25_index,
+    make_chunk_id,
+    mark_ingest_complete,
+    save_chunks,
+)
+
+DOCS_DIR = "/Users/swarnabha.saha/Library/CloudStorage/OneDrive-RelianceCorporateITParkLimited/Personal/Personal RAG/Docs"
+
+# Without an index every query is a brute-force scan over all vectors. Small
+# tables are still fastest that way (and too small to train the quantizer on).
+MIN_ROWS_FOR_INDEX = 5000
+# HNSW does the heavy lifting inside each IVF partition, so partitions can be large
+VECTORS_PER_PARTITION = 100_000
+# Held for the whole run; lives outside ./lancedb_data because that is deleted and rebuilt
+INGEST_LOCK_PATH = "./.ingest.lock"
+
+class IngestionInProgress(RuntimeError):
+    """Raised when another process (CLI run, app or server worker) is already ingesting."""
 
 # 1. Load Documents
+LOADERS = {
+    ".pdf": PyPDFium2Loader,
+    ".txt": TextLoader,
+    ".md": TextLoader,
+    ".xlsx": UnstructuredExcelLoader,
+}
+
+def _load_one(file_path):
+    # Runs in a worker process, so it must be a top-level (picklable) function
+    print(f"Loading: {file_path}")
+    try:
+        return LOADERS[os.path.splitext(file_path)[1]](file_path).load()
+    except Exception as e:
+        print(f"Error loading {file_path}: {e}")
+        return []
+
 def load_docs(directory):
-    loaders = {
-        ".pdf": PyPDFLoader,
-        ".txt": TextLoader,
-        ".md": TextLoader,
-        ".xlsx": UnstructuredExcelLoader,
-    }
-    documents = []
     print(f"Scanning directory: {directory}")
-    for root, _, files in os.walk(directory):
-        for file in files:
-            ext = os.path.splitext(file)[1]
-            if ext in loaders:
-                file_path = os.path.join(root, file)
-                print(f"Loading: {file_path}")
-                try:
-                    loader = loaders[ext](file_path)
-                    documents.extend(loader.load())
-                except Exception as e:
-                    print(f"Error loading {file_path}: {e}")
-    return documents
-
-# 2. Split Text (Semantic Chunking)
-docs_dir = "/Users/swarnabha.saha/Library/CloudStorage/OneDrive-RelianceCorporateITParkLimited/Personal/Personal RAG/Docs"
-if not os.path.exists(docs_dir):
-    print(f"Error: Directory not found: {docs_dir}")
-    sys.exit(1)
-
-docs = load_docs(docs_dir)
-
-if not docs:
-    print("No documents found.")
-    sys.exit(0)
-
-print(f"Loaded {len(docs)} documents.")
-
-print("Initializing embeddings for Semantic Chunking...")
-# Semantic Chunker needs embeddings to decide where to split
-embeddings = OllamaEmbeddings(model="nomic-embed-text")
-
-from langchain_experimental.text_splitter import SemanticChunker
-text_splitter = SemanticChunker(embeddings, breakpoint_threshold_type="percentile")
-
-print("Splitting documents (this may take a while)...")
-splits = text_splitter.split_documents(docs)
-print(f"Split into {len(splits)} chunks.")
-
-# 3. Vectorize & Store
-print("Initializing embeddings and vector store...")
-embeddings = OllamaEmbeddings(model="nomic-embed-text")
-if os.path.exists("./lancedb_data"):
-    shutil.rmtree("./lancedb_data")
-
-vector_store = LanceDB.from_documents(splits, embeddings, uri="./lancedb_data")
-print("✅ Ingestion Complete. Data stored locally.")
+    paths = [
+        os.path.join(root, file)
+        for root, _, files in os.walk(directory)
+        for file in files
+        if os.path.splitext(file)[1] in LOADERS
+    ]
+    # PDF parsing is CPU-bound, so fan it out across cores.
+    # Always spawn: forking the threaded app/server process is unsafe, and spawned workers only
+    # re-import its __main__, which keeps model and index setup out of module scope
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=context) as executor:
+        return list(itertools.chain.from_iterable(executor.map(_load_one, paths, chunksize=4)))
+
+# Static (lookup + mean-pool) embeddings: SemanticChunker only compares adjacent
+# sentences, so a tiny model2vec model is plenty and avoids an Ollama call per sentence.
+class StaticEmbeddings(Embeddings):
+    def __init__(self, model_name="minishlab/potion-base-8M"):
+        self.model = StaticModel.from_pretrained(model_name)
+
+    def embed_documents(self, texts):
+        return self.model.encode(texts).tolist()
+
+    def embed_query(self, text):
+        return self.model.encode([text])[0].tolist()
+
+def run_ingestion(docs_dir, embeddings=None):
+    """
+    Loads, chunks and embeds every document under docs_dir into ./lancedb_data.
+    Pass the caller's (already warm) embeddings to reuse them. Returns the chunks written.
+    Raises IngestionInProgress if another process is already ingesting.
+    """
+    # 2. Split Text (Semantic Chunking)
+    if not os.path.exists(docs_dir):
+        raise FileNotFoundError(f"Directory not found: {docs_dir}")
+
+    with open(INGEST_LOCK_PATH, "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise IngestionInProgress("Ingestion is already running.") from None
+        # The lock is released when the file is closed
+        return _run_ingestion(docs_dir, embeddings)
+
+def _run_ingestion(docs_dir, embeddings):
+    docs = load_docs(docs_dir)
+
+    if not docs:
+        print("No documents found.")
+        return []
+
+    print(f"Loaded {len(docs)} documents.")
+
+    print("Initializing embeddings for Semantic Chunking...")
+    # Semantic Chunker needs embeddings to decide where to split
+    chunking_embeddings = StaticEmbeddings()
+
+    from langchain_experimental.text_splitter import SemanticChunker
+    text_splitter = SemanticChunker(chunking_embeddings, breakpoint_threshold_type="percentile")
+
+    print("Splitting documents (this may take a while)...")
+    splits = text_splitter.split_documents(docs)
+    print(f"Split into {len(splits)} chunks.")
+    # Stable per-chunk ID, so retrieval can dedupe without hashing the text per query
+    for split in splits:
+        split.metadata["chunk_id"] = make_chunk_id(split.page_content)
+
+    # 3. Vectorize & Store
+    print("Initializing embeddings and vector store...")
+    # nomic-embed-text is still used for the stored vectors, where quality matters.
+    # Cached, so re-ingesting unchanged chunks skips the Ollama round-trip
+    if embeddings is None:
+        embeddings = CachedOllamaEmbeddings(model="nomic-embed-text")
+    if os.path.exists("./lancedb_data"):
+        shutil.rmtree("./lancedb_data")
+
+    LanceDB.from_documents(splits, embeddings, uri="./lancedb_data", table_name=VECTOR_TABLE)
+    # Same chunks for BM25, so app.py/server.py never re-parse the source files
+    save_chunks(splits, CHUNKS_PATH)
+    # Index them for BM25 now, so app.py/server.py only memory-map it on startup
+    load_or_build_bm25_index(CHUNKS_PATH, save=True)
+
+    # 4. Build ANN Index
+    table = lancedb.connect("./lancedb_data").open_table(VECTOR_TABLE)
+    num_rows = table.count_rows()
+    if num_rows >= MIN_ROWS_FOR_INDEX:
+        print(f"Building IVF_HNSW_SQ index over {num_rows} vectors...")
+        # HNSW graph over INT8 scalar-quantized vectors: a quarter of the FP32 bytes,
+        # near-exact distances, and far fewer vectors visited than an IVF_PQ partition scan.
+        # Metric matches the LanceDB vector store's default query distance (l2),
+        # otherwise searches would not use the index.
+        table.create_index(
+            metric="l2",
+            vector_column_name="vector",
+            index_type="IVF_HNSW_SQ",
+            num_partitions=max(1, num_rows // VECTORS_PER_PARTITION),
+        )
+    else:
+        print(f"Skipping ANN index ({num_rows} vectors, brute-force search is fast enough).")
+
+    # Last step: servers reload only once this marker appears, so they never see a partial store
+    mark_ingest_complete(len(splits))
+    print("✅ Ingestion Complete. Data stored locally.")
+    return splits
+
+def main():
+    try:
+        run_ingestion(DOCS_DIR)
+    except (FileNotFoundError, IngestionInProgress) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Shared retrieval components for the Chainlit app (app.py) and the FastAPI server (server.py).
+"""
+import hashlib
+import heapq
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import bm25s
+import httpx
+import lancedb
+import numpy as np
+import onnxruntime as ort
+import pyarrow as pa
+import pyarrow.parquet as pq
+import Stemmer
+import xxhash
+from diskcache import Cache
+from flashrank import Ranker, RerankRequest
+from flashrank.Config import model_file_map
+from langchain_core.documents import Document
+from langchain_ollama import OllamaEmbeddings
+from onnxruntime.quantization import QuantType, quantize_dynamic
+
+# --- Ollama ---
+# Keep models resident in Ollama (no multi-second reload after idle) and reuse pooled connections
+OLLAMA_KEEP_ALIVE = -1
+OLLAMA_CLIENT_KWARGS = {"limits": httpx.Limits(max_keepalive_connections=32)}
+
+# --- Embeddings ---
+EMBEDDING_CACHE_DIR = "./.emb_cache"
+embedding_cache = Cache(EMBEDDING_CACHE_DIR, size_limit=512 * 1024 ** 2)
+
+class CachedOllamaEmbeddings(OllamaEmbeddings):
+    """
+    OllamaEmbeddings backed by a persistent on-disk cache (diskcache), so repeated
+    queries and unchanged chunks skip the Ollama round-trip, including across restarts.
+    """
+
+    def _cache_key(self, text: str) -> str:
+        normalized = " ".join(text.split())
+        return hashlib.sha1(f"{self.model}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._cache_key(text) for text in texts]
+        vectors = [embedding_cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # Embed all cache misses in a single batched request
+            new_vectors = super().embed_documents([texts[i] for i in missing])
+            for i, vector in zip(missing, new_vectors):
+                embedding_cache.set(keys[i], vector)
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def warm_up(self):
+        """Forces Ollama to load the model now, bypassing the cache, instead of on the first user query."""
+        super().embed_documents(["warmup"])
+
+# --- Chunk Store ---
+# Written by ingest.py next to the vectors so BM25 indexes exactly the chunks the vector store holds
+CHUNKS_PATH = "./lancedb_data/chunks.parquet"
+
+def make_chunk_id(text: str) -> str:
+    return xxhash.xxh3_64_hexdigest(text.encode("utf-8"))
+
+def chunk_key(passage: Dict[str, Any]):
+    """Cheap dedup key for a passage: the chunk_id assigned at ingest, else a 64-bit hash of the content."""
+    return passage["meta"].get("chunk_id") or xxhash.xxh3_64_intdigest(passage["text"].encode("utf-8"))
+
+def save_chunks(splits: List[Document], path: str = CHUNKS_PATH):
+    rows = [
+        {
+            "text": doc.page_content,
+            "source": doc.metadata.get("source"),
+            "page": doc.metadata.get("page"),
+            "chunk_id": doc.metadata.get("chunk_id"),
+        }
+        for doc in splits
+    ]
+    pq.write_table(pa.Table.from_pylist(rows), path)
+
+def load_chunks(path: str = CHUNKS_PATH) -> List[Document]:
+    """Memory-maps the chunk store written by ingest.py. Returns [] if ingestion hasn't run yet."""
+    if not os.path.exists(path):
+        return []
+    table = pq.read_table(path, memory_map=True)
+    docs = []
+    for row in table.to_pylist():
+        text = row.pop("text")
+        docs.append(Document(page_content=text, metadata={k: v for k, v in row.items() if v is not None}))
+    return docs
+
+# --- Ingest Marker ---
+# Written by ingest.py as its very last step (after the ANN index is built), so readers only
+# ever reload a finished store, never one that is still being written
+INGEST_MARKER_PATH = "./lancedb_data/ingest_complete.json"
+
+def mark_ingest_complete(num_chunks: int, path: str = INGEST_MARKER_PATH):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"num_chunks": num_chunks}, f)
+    os.replace(tmp_path, path)
+
+def ingest_version(path: str = INGEST_MARKER_PATH) -> Optional[float]:
+    """mtime of the ingest marker: None before the first ingestion and while one is running."""
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+
+# --- BM25 (Keyword Search) ---
+# Saved alongside the chunk store, so re-ingestion (which wipes ./lancedb_data) also clears it
+BM25_INDEX_DIR = "./lancedb_data/bm25s_index"
+BM25_MANIFEST = "manifest.json"
+
+class BM25Index:
+    """
+    Keyword index over a list of Documents, backed by bm25s (sparse NumPy/SciPy scoring).
+    Drop-in replacement for langchain's rank_bm25-based BM25Retriever.
+    Pass a prebuilt (e.g. memory-mapped) bm25s retriever to skip indexing.
+    """
+
+    def __init__(self, docs: List[Document], k: int = 10, retriever: Optional[bm25s.BM25] = None):
+        self.docs = docs
+        self.k = k
+        self.stemmer = Stemmer.Stemmer("english")
+        if retriever is None:
+            corpus_tokens = bm25s.tokenize(
+                [doc.page_content for doc in docs],
+                stopwords="en",
+                stemmer=self.stemmer,
+                show_progress=False,
+            )
+            retriever = bm25s.BM25()
+            retriever.index(corpus_tokens, show_progress=False)
+        self.retriever = retriever
+
+    def search(self, query: str) -> List[Dict[str, Any]]:
+        """Returns up to k passages ({"text", "meta"}) matching the query, best first."""
+        k = min(self.k, len(self.docs))
+        if k == 0:
+            return []
+        query_tokens = bm25s.tokenize(
+            [query],
+            stopwords="en",
+            stemmer=self.stemmer,
+            return_ids=False,
+            show_progress=False,
+        )
+        indices, scores = self.retriever.retrieve(query_tokens, k=k, show_progress=False)
+        # Skip zero-score hits (no query term matched the document)
+        return [
+            {"text": self.docs[i].page_content, "meta": self.docs[i].metadata}
+            for i, score in zip(indices[0], scores[0])
+            if score > 0
+        ]
+
+def _chunks_fingerprint(chunks_path: str) -> Dict[str, Any]:
+    stat = os.stat(chunks_path)
+    return {"chunks_mtime": stat.st_mtime, "chunks_size": stat.st_size}
+
+def load_or_build_bm25_index(
+    chunks_path: str = CHUNKS_PATH, index_dir: str = BM25_INDEX_DIR, k: int = 10, save: bool = False
+) -> Optional[BM25Index]:
+    """
+    Memory-maps the saved BM25 index if it was built from the current chunk store,
+    otherwise builds it from the chunks (and, with save=True, saves it with a manifest).
+    Only ingest.py saves, so readers never write into an index directory it may be writing.
+    Returns None if there are no ingested chunks.
+    """
+    docs = load_chunks(chunks_path)
+    if not docs:
+        return None
+
+    fingerprint = _chunks_fingerprint(chunks_path)
+    manifest_path = os.path.join(index_dir, BM25_MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) == fingerprint:
+                return BM25Index(docs, k=k, retriever=bm25s.BM25.load(index_dir, mmap=True))
+
+    index = BM25Index(docs, k=k)
+    if save:
+        index.retriever.save(index_dir)
+        with open(manifest_path, "w") as f:
+            json.dump(fingerprint, f)
+    return index
+
+# --- Candidate Fusion ---
+# Reciprocal-rank fusion (RRF) of the vector and BM25 result lists picks which
+# passages are worth sending to the cross-encoder
+RRF_K = 60
+RERANK_CANDIDATES = 15
+
+def rrf_fuse(fused: Dict[Any, List], ranked: List[Dict[str, Any]]):
+    """
+    Folds one best-first result list into fused ({chunk_key: [rrf_score, passage]}),
+    adding 1 / (RRF_K + rank) per list a passage appears in. Also dedupes across lists.
+    """
+    for rank, passage in enumerate(ranked, start=1):
+        entry = fused.setdefault(chunk_key(passage), [0.0, passage])
+        entry[0] += 1 / (RRF_K + rank)
+
+def rrf_top(fused: Dict[Any, List], n: int = RERANK_CANDIDATES) -> List[Any]:
+    """Keys of the n passages with the highest fused score, best first."""
+    return heapq.nlargest(n, fused, key=lambda key: fused[key][0])
+
+# --- Vector Search ---
+# langchain's LanceDB store writes "vectorstore" by default; ingest.py passes this name explicitly
+VECTOR_TABLE = "vectorstore"
+
+class VectorIndex:
+    """
+    Searches the LanceDB table written by ingest.py through the native lancedb API.
+    Passages ({"text", "meta"}) come straight from the Arrow result, skipping the per-row
+    Document construction and validation of langchain's LanceDB wrapper.
+    """
+
+    def __init__(self, uri: str, embeddings: OllamaEmbeddings, table_name: str = VECTOR_TABLE):
+        self.embeddings = embeddings
+        db = lancedb.connect(uri)
+        self.table = db.open_table(table_name) if table_name in db.table_names() else None
+        if self.table is None and ingest_version(os.path.join(uri, os.path.basename(INGEST_MARKER_PATH))) is not None:
+            print(f"Warning: table '{table_name}' not found in {uri} after a completed ingestion. Vector search disabled.")
+        # IVF tuning knobs only apply once ingest.py has built an ANN index
+        self.indexed = self.table is not None and bool(self.table.list_indices())
+
+    def search(self, query: str, k: int = 5) -> List[Dict[str, Any]]:
+        return self.search_by_vector(self.embeddings.embed_query(query), k=k)
+
+    def search_by_vector(self, vector: List[float], k: int = 5) -> List[Dict[str, Any]]:
+        if self.table is None:
+            return []
+        # l2 matches the metric the ANN index is built with in ingest.py
+        query = self.table.search(np.asarray(vector, dtype=np.float32), vector_column_name="vector").distance_type("l2")
+        if self.indexed:
+            # Probe more partitions, then re-rank 10x the candidates on the full vectors
+            query = query.nprobes(20).refine_factor(10)
+        result = query.select(["text", "metadata"]).limit(k).to_arrow()
+        return [
+            {"text": text, "meta": meta or {}}
+            for text, meta in zip(result.column("text").to_pylist(), result.column("metadata").to_pylist())
+        ]
+
+# --- Re-ranker ---
+RERANK_THREADS = int(os.environ.get("OMP_NUM_THREADS", "4"))
+
+class QuantizedRanker(Ranker):
+    """
+    FlashRank Ranker that runs an INT8 dynamically-quantized copy of the cross-encoder on CPU,
+    or the FP32 model through CoreML where it is available.
+    The quantized model is written next to the FP32 one in the FlashRank cache on first use.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str, max_length: int = 512):
+        # Same setup as Ranker.__init__, minus the FP32 InferenceSession it would build only to
+        # be replaced below
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = Path(cache_dir)
+        self.model_dir = self.cache_dir / model_name
+        self._prepare_model_dir(model_name)
+        self.llm_model = None
+        self.tokenizer = self._get_tokenizer(max_length)
+
+        model_path = self.model_dir / model_file_map[model_name]
+        providers = ["CPUExecutionProvider"]
+        if "CoreMLExecutionProvider" in ort.get_available_providers():
+            # On Apple Silicon, CoreML runs the FP32 model. It has no kernels for the INT8 graph's
+            # DynamicQuantizeLinear/MatMulInteger ops, so that graph would be split between CoreML
+            # and CPU with a copy at every boundary
+            providers.insert(0, ("CoreMLExecutionProvider", {"ModelFormat": "MLProgram"}))
+        else:
+            model_path = self._quantize(model_path)
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # Fixed, small thread pool: the ORT default (one per logical core) fights the
+        # event loop and Ollama for cores
+        opts.intra_op_num_threads = RERANK_THREADS
+        opts.inter_op_num_threads = 1
+        opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        self.session = ort.InferenceSession(str(model_path), sess_options=opts, providers=providers)
+
+    @staticmethod
+    def _quantize(fp32_path: Path) -> Path:
+        """Returns the INT8 copy of the model, quantizing it on first use."""
+        int8_path = fp32_path.with_suffix(".int8.onnx")
+        if not int8_path.exists():
+            print(f"Quantizing re-ranker to INT8: {int8_path.name}")
+            # Write to a per-process temp file and rename it into place, so other workers never
+            # load a half-written model
+            tmp_path = int8_path.with_name(f"{int8_path.name}.{os.getpid()}.tmp")
+            # Only MatMul weights are quantized; the embedding lookup stays FP32
+            quantize_dynamic(
+                str(fp32_path),
+                str(tmp_path),
+                op_types_to_quantize=["MatMul"],
+                weight_type=QuantType.QInt8,
+            )
+            os.replace(tmp_path, int8_path)
+        return int8_path
+
+    def rerank(self, request: RerankRequest, top_k: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Scores all passages with one tokenizer call and one ONNX forward pass over the padded batch.
+        Returns the top_k passages (all of them if top_k is None), best first.
+        """
+        passages = request.passages
+        if not passages:
+            return []
+
+        encoded = self.tokenizer.encode_batch([(request.query, p["text"]) for p in passages])
+        onnx_input = {
+            "input_ids": np.array([e.ids for e in encoded], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encoded], dtype=np.int64),
+        }
+        token_type_ids = np.array([e.type_ids for e in encoded], dtype=np.int64)
+        if token_type_ids.any():
+            onnx_input["token_type_ids"] = token_type_ids
+
+        logits = self.session.run(None, onnx_input)[0]
+        if logits.shape[1] == 1:
+            scores = 1 / (1 + np.exp(-logits[:, 0]))
+        else:
+            exp_logits = np.exp(logits - logits.max(axis=1, keepdims=True))
+            scores = exp_logits[:, 1] / exp_logits.sum(axis=1)
+
+        if top_k is not None and 0 < top_k < len(scores):
+            # O(N) selection of the top_k, then sort only those
+            order = np.argpartition(scores, -top_k)[-top_k:]
+            order = order[np.argsort(-scores[order])]
+        else:
+            order = np.argsort(-scores)[:top_k]
+        return [{**passages[i], "score": float(scores[i])} for i in order]
@@ -1,20 +1,37 @@
 """
 Local RAG Search Agent - FastAPI Server
 Exposes local LanceDB search via a secure endpoint.
-Run with: uvicorn server:app --host 0.0.0.0 --port 8000
+Run with: python server.py
+or: OMP_NUM_THREADS=2 uvicorn server:app --host 0.0.0.0 --port 8000 --workers 4
+(each worker runs its own re-ranker with OMP_NUM_THREADS threads, so keep workers x threads <= cores)
 """
 import os
+# Cap native thread pools (OpenMP/MKL) before NumPy and ONNX Runtime are imported,
+# so they don't oversubscribe cores alongside the event loop and Ollama
+os.environ.setdefault("OMP_NUM_THREADS", "4")
+os.environ.setdefault("MKL_NUM_THREADS", "4")
+import asyncio
+import threading
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
-import subprocess
-import sys
-from langchain_ollama import OllamaEmbeddings
-from langchain_community.vectorstores import LanceDB
-from langchain_community.retrievers import BM25Retriever
-from langchain_community.document_loaders import PyPDFLoader, TextLoader
-from flashrank import Ranker, RerankRequest
+from flashrank import RerankRequest
+from ingest import IngestionInProgress, run_ingestion
+from retrieval import (
+    CHUNKS_PATH,
+    OLLAMA_CLIENT_KWARGS,
+    OLLAMA_KEEP_ALIVE,
+    RERANK_CANDIDATES,
+    CachedOllamaEmbeddings,
+    QuantizedRanker,
+    VectorIndex,
+    ingest_version,
+    load_or_build_bm25_index,
+    rrf_fuse,
+    rrf_top,
+)
 
 # --- Configuration ---
 EMBEDDING_MODEL = "nomic-embed-text"
@@ -41,51 +58,84 @@ class HealthResponse(BaseModel):
     bm25_ready: bool
 
 # --- Initialize Components ---
-print("🚀 Initializing Local RAG Agent...")
-
-print("  [1/4] Loading Embeddings...")
-embeddings = OllamaEmbeddings(model=EMBEDDING_MODEL)
-
-print("  [2/4] Connecting to Vector Store...")
-if not os.path.exists(LANCEDB_URI):
-    os.makedirs(LANCEDB_URI)
-vector_store = LanceDB(embedding=embeddings, uri=LANCEDB_URI)
-
-print("  [3/4] Initializing Re-ranker...")
-reranker = Ranker(model_name="ms-marco-TinyBERT-L-2-v2", cache_dir="./.flashrank_cache")
-
-print("  [4/4] Building BM25 Index...")
-def load_docs_for_bm25(directory: str):
-    loaders = {".pdf": PyPDFLoader, ".txt": TextLoader, ".md": TextLoader}
-    documents = []
-    if os.path.exists(directory):
-        for root, _, files in os.walk(directory):
-            for file in files:
-                ext = os.path.splitext(file)[1]
-                if ext in loaders:
-                    try:
-                        loader = loaders[ext](os.path.join(root, file))
-                        documents.extend(loader.load())
-                    except Exception as e:
-                        print(f"  ⚠️ BM25 Load Error for {file}: {e}")
-    return documents
-
-bm25_docs = load_docs_for_bm25(DOCS_DIR)
+# Set by init_components() when the app starts, not at import: uvicorn's supervisor process and
+# multiprocessing's re-import of __main__ (spawned workers, ingest's process pool) import this
+# module too, and should not load models or indexes
+embeddings = None
+vector_store = None
+reranker = None
 bm25_retriever = None
-if bm25_docs:
-    bm25_retriever = BM25Retriever.from_documents(bm25_docs)
-    bm25_retriever.k = 10
-    print(f"  ✅ BM25 Index built with {len(bm25_docs)} documents.")
-else:
-    print("  ⚠️ No documents found for BM25. Keyword search disabled.")
+indexes_version = None
+reload_lock = threading.Lock()
+# A second /ingest to this worker is turned away instead of racing the first one;
+# run_ingestion's file lock does the same across workers
+ingest_lock = asyncio.Lock()
+
+def init_components():
+    global embeddings, vector_store, reranker, bm25_retriever, indexes_version
+    print("🚀 Initializing Local RAG Agent...")
+    # Taken first, so an ingestion finishing while we load is picked up by the next /search
+    indexes_version = ingest_version()
+
+    print("  [1/4] Loading Embeddings...")
+    embeddings = CachedOllamaEmbeddings(model=EMBEDDING_MODEL, keep_alive=OLLAMA_KEEP_ALIVE, client_kwargs=OLLAMA_CLIENT_KWARGS)
+
+    print("  [2/4] Connecting to Vector Store...")
+    if not os.path.exists(LANCEDB_URI):
+        os.makedirs(LANCEDB_URI)
+    vector_store = VectorIndex(LANCEDB_URI, embeddings)
+
+    print("  [3/4] Initializing Re-ranker...")
+    reranker = QuantizedRanker(model_name="ms-marco-TinyBERT-L-2-v2", cache_dir="./.flashrank_cache")
+
+    print("  [4/4] Loading BM25 Index...")
+    bm25_retriever = load_or_build_bm25_index(CHUNKS_PATH)
+    if bm25_retriever:
+        print(f"  ✅ BM25 Index ready with {len(bm25_retriever.docs)} chunks.")
+    else:
+        print("  ⚠️ No ingested chunks found for BM25. Keyword search disabled.")
+
+    # Load the embedding model into Ollama now so the first /search doesn't pay the cold-start.
+    # Only an optimization: if Ollama isn't up yet, start anyway so /health can still answer
+    try:
+        embeddings.warm_up()
+    except Exception as e:
+        print(f"  ⚠️ Embedding warm-up failed, continuing without it: {e}")
 
-print("✅ Local RAG Agent Ready!")
+    print("✅ Local RAG Agent Ready!")
+
+def reload_indexes():
+    """
+    Re-opens the vector store and BM25 index if an ingestion has completed since they were loaded.
+    Serialized, so concurrent requests that notice the same ingestion reload only once.
+    """
+    global vector_store, bm25_retriever, indexes_version
+    with reload_lock:
+        version = ingest_version()
+        if version is None or version == indexes_version:
+            return
+
+        vector_store = VectorIndex(LANCEDB_URI, embeddings)
+        print("  ✅ Vector store reloaded.")
+
+        bm25_retriever = load_or_build_bm25_index(CHUNKS_PATH)
+        if bm25_retriever:
+            print(f"  ✅ BM25 Index reloaded with {len(bm25_retriever.docs)} chunks.")
+        else:
+            print("  ⚠️ No ingested chunks found for BM25 after reload.")
+        indexes_version = version
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_components()
+    yield
 
 # --- FastAPI App ---
 app = FastAPI(
     title="Local RAG Search Agent",
     description="Exposes local LanceDB vector search for the cloud frontend.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 # CORS: Allow the Vercel frontend to connect
@@ -102,7 +152,7 @@ async def health_check():
     """Health check endpoint for the tunnel/frontend."""
     return HealthResponse(
         status="ok",
-        vector_store_ready=vector_store is not None,
+        vector_store_ready=vector_store.table is not None,
         bm25_ready=bm25_retriever is not None
     )
 
@@ -114,61 +164,45 @@ class IngestResponse(BaseModel):
 @app.post("/ingest", response_model=IngestResponse)
 async def trigger_ingestion():
     """
-    Trigger document ingestion: runs ingest.py and reloads the vector store and BM25 index.
+    Trigger document ingestion: runs ingest.run_ingestion and reloads the vector store and BM25 index.
+    Runs to completion once started; a request made while one is running is rejected.
     """
-    global vector_store, bm25_retriever, bm25_docs
+    if ingest_lock.locked():
+        return IngestResponse(status="error", message="Ingestion is already running.")
     
-    try:
-        # Step 1: Run the ingest.py script
-        print("🔄 Running ingestion script...")
-        result = subprocess.run(
-            [sys.executable, "ingest.py"],
-            cwd=os.path.dirname(os.path.abspath(__file__)),
-            capture_output=True,
-            text=True,
-            timeout=600  # 10 minute timeout for large document sets
-        )
-        
-        if result.returncode != 0:
-            print(f"❌ Ingestion failed: {result.stderr}")
+    async with ingest_lock:
+        try:
+            # Step 1: Run ingestion in-process (in a worker thread), reusing the warm embeddings
+            print("🔄 Running ingestion...")
+            await asyncio.to_thread(run_ingestion, DOCS_DIR, embeddings)
+            
+            print("✅ Ingestion completed. Reloading indexes...")
+            
+            # Step 2: Reload the vector store and BM25 index
+            await asyncio.to_thread(reload_indexes)
+            
+            return IngestResponse(
+                status="success",
+                message="Knowledge base refreshed successfully!",
+                documents_processed=len(bm25_retriever.docs) if bm25_retriever else 0
+            )
+            
+        except IngestionInProgress as e:
+            return IngestResponse(status="error", message=str(e))
+        except Exception as e:
+            print(f"❌ Ingestion error: {e}")
             return IngestResponse(
                 status="error",
-                message=f"Ingestion script failed: {result.stderr}"
+                message=f"Ingestion error: {str(e)}"
             )
-        
-        print("✅ Ingestion script completed. Reloading indexes...")
-        
-        # Step 2: Reload the vector store
-        vector_store = LanceDB(embedding=embeddings, uri=LANCEDB_URI)
-        print("  ✅ Vector store reloaded.")
-        
-        # Step 3: Reload BM25 index
-        bm25_docs = load_docs_for_bm25(DOCS_DIR)
-        if bm25_docs:
-            bm25_retriever = BM25Retriever.from_documents(bm25_docs)
-            bm25_retriever.k = 10
-            print(f"  ✅ BM25 Index rebuilt with {len(bm25_docs)} documents.")
-        else:
-            bm25_retriever = None
-            print("  ⚠️ No documents found for BM25 after reload.")
-        
-        return IngestResponse(
-            status="success",
-            message="Knowledge base refreshed successfully!",
-            documents_processed=len(bm25_docs) if bm25_docs else 0
-        )
-        
-    except subprocess.TimeoutExpired:
-        return IngestResponse(
-            status="error",
-            message="Ingestion timed out after 10 minutes."
-        )
+
+async def run_search(kind: str, fn, *args, **kwargs):
+    """Runs a blocking search in a worker thread; a failed search contributes no results."""
+    try:
+        return await asyncio.to_thread(fn, *args, **kwargs)
     except Exception as e:
-        print(f"❌ Ingestion error: {e}")
-        return IngestResponse(
-            status="error",
-            message=f"Ingestion error: {str(e)}"
-        )
+        print(f"{kind} search error: {e}")
+        return []
 
 @app.post("/search", response_model=SearchResponse)
 async def search(request: SearchRequest):
@@ -182,37 +216,30 @@ async def search(request: SearchRequest):
     if not query:
         raise HTTPException(status_code=400, detail="Query cannot be empty.")
     
-    unique_docs = {}
-    
-    # 1. Vector Search
-    try:
-        v_results = vector_store.similarity_search(query, k=10)
-        for doc in v_results:
-            unique_docs[doc.page_content] = {"text": doc.page_content, "meta": doc.metadata}
-    except Exception as e:
-        print(f"Vector search error: {e}")
+    # With several workers, /ingest only reloads the worker that served it;
+    # the others pick up the new indexes here, once the ingestion has fully completed
+    version = ingest_version()
+    if version is not None and version != indexes_version:
+        await asyncio.to_thread(reload_indexes)
     
-    # 2. BM25 Keyword Search
+    # 1. Vector Search + 2. BM25 Keyword Search, concurrently and off the event loop
+    searches = [run_search("Vector", vector_store.search, query, k=10)]
     if bm25_retriever:
-        try:
-            k_results = bm25_retriever.invoke(query)
-            for doc in k_results:
-                unique_docs[doc.page_content] = {"text": doc.page_content, "meta": doc.metadata}
-        except Exception as e:
-            print(f"BM25 search error: {e}")
+        searches.append(run_search("BM25", bm25_retriever.search, query))
     
-    if not unique_docs:
+    fused = {}  # chunk_key -> [rrf_score, passage]
+    for ranked in await asyncio.gather(*searches):
+        rrf_fuse(fused, ranked)
+    
+    if not fused:
         return SearchResponse(results=[], query=query)
     
-    # 3. Re-rank
-    passages = [
-        {"id": str(i), "text": d["text"], "meta": d["meta"]}
-        for i, d in enumerate(unique_docs.values())
-    ]
+    # 3. Re-rank only the best candidates by reciprocal-rank fusion
+    candidates = rrf_top(fused, max(RERANK_CANDIDATES, top_k))
+    passages = [{"id": str(i), **fused[key][1]} for i, key in enumerate(candidates)]
     
     rerank_request = RerankRequest(query=query, passages=passages)
-    reranked = reranker.rerank(rerank_request)
-    reranked = sorted(reranked, key=lambda x: x["score"], reverse=True)[:top_k]
+    reranked = await asyncio.to_thread(reranker.rerank, rerank_request, top_k=top_k)
     
     results = [
         SearchResult(
@@ -227,4 +254,12 @@ async def search(request: SearchRequest):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    cores = os.cpu_count() or 2
+    workers = max(1, cores // 2)
+    # Each worker process loads its own indexes and re-ranker session on startup (see lifespan).
+    # Split the native thread budget between them so workers x re-ranker threads stays within
+    # the cores; workers read it from the environment they are spawned with
+    threads_per_worker = str(max(1, cores // workers))
+    os.environ["OMP_NUM_THREADS"] = threads_per_worker
+    os.environ["MKL_NUM_THREADS"] = threads_per_worker
+    uvicorn.run("server:app", host="0.0.0.0", port=8000, workers=workers)